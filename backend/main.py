@@ -1,22 +1,357 @@
 from firebase_functions import https_fn
-from firebase_admin import initialize_app, messaging
-import json
+from firebase_admin import exceptions, initialize_app, messaging
+import cachetools
+import concurrent.futures
+import functools
+import logging
+import math
 import os
-from datetime import datetime, timedelta, UTC
+import re
+import threading
+import time
+from datetime import datetime, UTC
 from google.cloud import tasks_v2
 import google.auth
+from requests.adapters import DEFAULT_POOLSIZE
 
-# Initialize the Firebase app
-initialize_app()
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    import json
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    _loads = json.loads
 
 # Get project details
-_, project_id = google.auth.default()
-project_id = os.environ.get('PROJECT_ID', project_id)
 location = os.environ.get('CLOUD_REGION', 'us-central1')
 queue_name = os.environ.get('TASK_QUEUE', 'fcm-notification-queue')
 
-# Create a Cloud Tasks client
-tasks_client = tasks_v2.CloudTasksClient()
+# The Firebase app, project id and Cloud Tasks client are created on first use
+# so cold starts only pay for what the invoked function needs
+_app = None
+_project_id = None
+_tasks_client = None
+_init_lock = threading.Lock()
+
+def _env_project_id() -> str | None:
+    """Project id from the environment; the Cloud Functions runtime sets GOOGLE_CLOUD_PROJECT/GCP_PROJECT"""
+    return (
+        os.environ.get('PROJECT_ID')
+        or os.environ.get('GOOGLE_CLOUD_PROJECT')
+        or os.environ.get('GCP_PROJECT')
+    )
+
+def _get_project_id() -> str:
+    global _project_id
+    if _project_id is None:
+        with _init_lock:
+            if _project_id is None:
+                project_id = _env_project_id()
+                if not project_id:
+                    # Fall back to probing Application Default Credentials
+                    _, project_id = google.auth.default()
+                _project_id = project_id
+    return _project_id
+
+def _get_app():
+    """Initialize the Firebase app on first use"""
+    global _app
+    if _app is None:
+        # initialize_app() raises if called twice, so concurrent first requests must not race;
+        # the other lazy singletons use the same lock so each is built exactly once
+        with _init_lock:
+            if _app is None:
+                project_id = _env_project_id()
+                # Passing the project id skips credential-based project discovery
+                _app = initialize_app(options={'projectId': project_id} if project_id else None)
+    return _app
+
+def _get_tasks() -> tasks_v2.CloudTasksClient:
+    """Create the Cloud Tasks client on first use"""
+    global _tasks_client
+    if _tasks_client is None:
+        with _init_lock:
+            if _tasks_client is None:
+                # Only unary create_task calls are made, so REST is as fast per call as gRPC
+                # and avoids setting up a gRPC channel on cold start
+                _tasks_client = tasks_v2.CloudTasksClient(transport="rest")
+    return _tasks_client
+
+@functools.lru_cache(maxsize=1)
+def _get_queue_parent() -> str:
+    """Parent queue path for scheduled tasks, computed once per instance"""
+    # queue_path is a static helper, so it doesn't need a client instance
+    return tasks_v2.CloudTasksClient.queue_path(_get_project_id(), location, queue_name)
+
+@functools.lru_cache(maxsize=1)
+def _get_function_url() -> str:
+    """URL of the function that will send the notification, computed once per instance"""
+    return f"https://{location}-{_get_project_id()}.cloudfunctions.net/send_notification"
+
+_TASK_HEADERS = {"Content-Type": "application/json"}
+
+@functools.lru_cache(maxsize=1)
+def _get_task_template() -> tasks_v2.Task:
+    """Task with the fields shared by every scheduled notification, copied per request"""
+    return tasks_v2.Task(
+        http_request=tasks_v2.HttpRequest(
+            http_method=tasks_v2.HttpMethod.POST,
+            url=_get_function_url(),
+            headers=_TASK_HEADERS
+        )
+    )
+
+# FCM accepts at most 500 messages per batch request
+FCM_BATCH_SIZE = 500
+
+def _chunks(items, size=FCM_BATCH_SIZE):
+    """Yield successive slices of at most `size` items"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _get_tokens(data) -> tuple[list, bool]:
+    """
+    Return the device tokens of a request and whether it is a batch request
+    
+    A non-null "tokens" makes it a batch request; otherwise the single "token" is used.
+    """
+    tokens = data.get("tokens")
+    if tokens is None:
+        token = data.get("token")
+        return ([token] if token else []), False
+    return (tokens if isinstance(tokens, list) else []), True
+
+# FCM registration tokens are long strings of URL-safe characters
+_TOKEN_RE = re.compile(r"^[A-Za-z0-9_:\-]{100,}$")
+
+# Largest accepted title plus body in UTF-8 bytes. APNs rejects payloads over 4KB,
+# so this leaves room for the rest of the aps dictionary.
+MAX_TEXT_BYTES = 3584
+
+# Cloud Tasks only accepts schedule times up to 30 days ahead
+MAX_DELAY_SECONDS = 30 * 24 * 60 * 60
+
+def _validate_notification(tokens: list, title, body) -> str | None:
+    """
+    Return an error message if the notification is invalid, otherwise None
+    
+    Runs before any SDK object is built so bad input never costs an allocation or a network call.
+    """
+    for token in tokens:
+        if not isinstance(token, str) or not _TOKEN_RE.match(token):
+            return "Invalid token"
+    if not isinstance(title, str):
+        return "Invalid title"
+    if not isinstance(body, str):
+        return "Invalid body"
+    if len(title.encode()) + len(body.encode()) > MAX_TEXT_BYTES:
+        return "Notification too large"
+    return None
+
+def _parse_delay(value) -> int | None:
+    """Return `value` as a delay in seconds, or None if it is not a non-negative integer in range"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        # JSON clients may send integral floats such as 60.0
+        if not value.is_integer():
+            return None
+        value = int(value)
+    elif isinstance(value, str):
+        try:
+            value = int(value)
+        except ValueError:
+            return None
+    if not isinstance(value, int) or not 0 <= value <= MAX_DELAY_SECONDS:
+        return None
+    return value
+
+def _bad_request(error: str) -> https_fn.Response:
+    return https_fn.Response(
+        _dumps({"error": error}),
+        status=400,
+        content_type="application/json"
+    )
+
+# Shared APNS settings for every message; the SDK only reads it when encoding
+_DEFAULT_APNS = messaging.APNSConfig(
+    payload=messaging.APNSPayload(
+        aps=messaging.Aps(
+            badge=1,
+            sound="default"
+        )
+    )
+)
+
+# FCM errors meaning the token will keep failing, e.g. after the app is uninstalled.
+# InvalidArgumentError is left out: FCM also raises it for bad payloads, not just bad tokens.
+_DEAD_TOKEN_ERRORS = (messaging.UnregisteredError,)
+
+# Per-instance cache of tokens that recently failed with a _DEAD_TOKEN_ERRORS error.
+# Entries expire so a token that is registered again recovers.
+_dead_tokens = cachetools.TTLCache(maxsize=100_000, ttl=3600)
+_dead_tokens_lock = threading.Lock()
+
+def _is_dead_token(token: str) -> bool:
+    with _dead_tokens_lock:
+        return token in _dead_tokens
+
+def _mark_dead_token(token: str) -> None:
+    with _dead_tokens_lock:
+        _dead_tokens[token] = True
+
+def _dead_token_result(token: str) -> dict:
+    return {"token": token, "success": False, "error": "unregistered"}
+
+# FCM errors that may succeed if the same send is tried again later
+_RETRYABLE_ERRORS = (
+    messaging.QuotaExceededError,
+    exceptions.UnavailableError,
+    exceptions.InternalError,
+    exceptions.DeadlineExceededError
+)
+
+def _failure_result(token: str, error: Exception) -> dict:
+    return {
+        "token": token,
+        "success": False,
+        "error": str(error),
+        "retryable": isinstance(error, _RETRYABLE_ERRORS)
+    }
+
+def _collect_responses(tokens, batch_response, results: list) -> None:
+    """Append one result entry per token of a BatchResponse"""
+    for token, response in zip(tokens, batch_response.responses):
+        if response.success:
+            results.append({"token": token, "success": True, "message_id": response.message_id})
+        else:
+            if isinstance(response.exception, _DEAD_TOKEN_ERRORS):
+                _mark_dead_token(token)
+            results.append(_failure_result(token, response.exception))
+
+def _send_chunk(send, tokens: list, results: list) -> None:
+    """
+    Run one batch request and collect its results
+    
+    If the whole request fails, every token in it is recorded as failed, so the
+    chunks already sent keep their results instead of being lost to the exception.
+    """
+    try:
+        batch_response = send()
+    except Exception as e:
+        results.extend(_failure_result(token, e) for token in tokens)
+        return
+    _collect_responses(tokens, batch_response, results)
+
+def _batch_summary(results: list) -> dict:
+    success_count = sum(1 for result in results if result["success"])
+    return {
+        "success_count": success_count,
+        "failure_count": len(results) - success_count,
+        "responses": results
+    }
+
+def _send_one(token: str, title: str, body: str) -> str:
+    """Send a notification to a single device and return the FCM message id"""
+    _get_app()
+    message = messaging.Message(
+        notification=messaging.Notification(title=title, body=body),
+        token=token,
+        apns=_DEFAULT_APNS
+    )
+    try:
+        return messaging.send(message)
+    except _DEAD_TOKEN_ERRORS:
+        _mark_dead_token(token)
+        raise
+
+def _send_multicast(tokens: list, title: str, body: str) -> dict:
+    """
+    Send the same notification to every token, batched in chunks of FCM_BATCH_SIZE
+    """
+    _get_app()
+    results = []
+    live_tokens = []
+    for token in tokens:
+        if _is_dead_token(token):
+            results.append(_dead_token_result(token))
+        else:
+            live_tokens.append(token)
+    
+    for chunk in _chunks(live_tokens):
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(title=title, body=body),
+            tokens=chunk,
+            apns=_DEFAULT_APNS
+        )
+        _send_chunk(lambda: messaging.send_each_for_multicast(message), chunk, results)
+    return _batch_summary(results)
+
+def _send_each(notifications: list) -> dict:
+    """
+    Send notifications with individual titles/bodies, batched in chunks of FCM_BATCH_SIZE
+    
+    Each notification is a dict with "token", "title" and "body" keys
+    """
+    _get_app()
+    results = []
+    live_notifications = []
+    for notification in notifications:
+        if _is_dead_token(notification["token"]):
+            results.append(_dead_token_result(notification["token"]))
+        else:
+            live_notifications.append(notification)
+    
+    for chunk in _chunks(live_notifications):
+        messages = [
+            messaging.Message(
+                notification=messaging.Notification(
+                    title=notification.get("title", "Notification"),
+                    body=notification.get("body", "You have a notification")
+                ),
+                token=notification["token"],
+                apns=_DEFAULT_APNS
+            )
+            for notification in chunk
+        ]
+        tokens = [notification["token"] for notification in chunk]
+        _send_chunk(lambda: messaging.send_each(messages), tokens, results)
+    return _batch_summary(results)
+
+def _ndjson_response(summary: dict) -> https_fn.Response:
+    """
+    Stream a batch summary as NDJSON: one line with the counts, then one line per result
+    
+    Lines are encoded as they are sent, so large batches are never held as a single string.
+    """
+    def _iter():
+        yield _dumps({
+            "success": summary["failure_count"] == 0,
+            "success_count": summary["success_count"],
+            "failure_count": summary["failure_count"]
+        }) + b"\n"
+        for result in summary["responses"]:
+            yield _dumps(result) + b"\n"
+    
+    return https_fn.Response(_iter(), status=200, content_type="application/x-ndjson")
+
+def _send_to_request_tokens(tokens: list, is_batch: bool, title: str, body: str) -> dict:
+    """
+    Send a notification to the tokens returned by _get_tokens
+    
+    A single token returns its message id and raises on failure, unless it is a
+    known dead token; a batch returns the batch summary.
+    """
+    if not is_batch:
+        if _is_dead_token(tokens[0]):
+            return {"success": False, "error": "unregistered"}
+        return {"success": True, "message_id": _send_one(tokens[0], title, body)}
+    summary = _send_multicast(tokens, title, body)
+    return {"success": summary["failure_count"] == 0, **summary}
 
 @https_fn.on_call()
 def send_test_notification(req: https_fn.CallableRequest) -> dict:
@@ -25,7 +360,7 @@ def send_test_notification(req: https_fn.CallableRequest) -> dict:
     
     Expected request data:
     {
-        "token": "FCM device token",
+        "token": "FCM device token",  # or "tokens": ["token", ...]
         "title": "Notification title",
         "body": "Notification body"
     }
@@ -33,34 +368,59 @@ def send_test_notification(req: https_fn.CallableRequest) -> dict:
     try:
         # Get data from request
         data = req.data
+        if not isinstance(data, dict):
+            return {"success": False, "error": "Invalid request data"}
+        tokens, is_batch = _get_tokens(data)
         
-        if not data.get("token"):
+        if not tokens:
             return {"success": False, "error": "Missing device token"}
         
-        # Create message
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=data.get("title", "Test Notification"),
-                body=data.get("body", "This is a test notification from Firebase")
-            ),
-            token=data.get("token"),
-            apns=messaging.APNSConfig(
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(
-                        badge=1,
-                        sound="default"
-                    )
-                )
-            )
-        )
+        title = data.get("title", "Test Notification")
+        body = data.get("body", "This is a test notification from Firebase")
         
-        # Send message
-        response = messaging.send(message)
-        return {"success": True, "message_id": response}
+        error = _validate_notification(tokens, title, body)
+        if error:
+            return {"success": False, "error": error}
+        
+        return _send_to_request_tokens(tokens, is_batch, title, body)
         
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+# Maximum number of concurrent create_task calls per bulk schedule request. The REST
+# transport's requests session pools DEFAULT_POOLSIZE connections per host; more workers
+# than that would open and drop extra connections instead of reusing them.
+BULK_SCHEDULE_WORKERS = DEFAULT_POOLSIZE
+
+# Most notifications or tokens accepted by one bulk request, so a single request's
+# sends or create_task calls fit comfortably inside the function timeout
+MAX_BULK_NOTIFICATIONS = 1000
+
+@functools.lru_cache(maxsize=1024)
+def _task_payload(token: str, title: str, body: str) -> bytes:
+    """
+    Encode the send_notification request body for a task
+    
+    Memoized so retried or repeated schedules for the same notification reuse the bytes.
+    """
+    # Cloud Tasks takes the body as bytes, which _dumps produces directly
+    return _dumps({"token": token, "notification": {"title": title, "body": body}})
+
+def _build_task(token: str, title: str, body: str, schedule_seconds: int) -> tasks_v2.Task:
+    """Build a Cloud Tasks task that calls send_notification at `schedule_seconds` (Unix time)"""
+    return _build_task_with_payload(_task_payload(token, title, body), schedule_seconds)
+
+def _build_task_with_payload(payload: bytes, schedule_seconds: int) -> tasks_v2.Task:
+    """Build a Cloud Tasks task that posts `payload` to send_notification at `schedule_seconds`"""
+    # Copy the template and fill in only the per-task fields on the underlying protobuf
+    task = tasks_v2.Task()
+    task_pb = tasks_v2.Task.pb(task)
+    task_pb.CopyFrom(tasks_v2.Task.pb(_get_task_template()))
+    task_pb.http_request.body = payload
+    # Set the Timestamp directly rather than round-tripping through an ISO string
+    task_pb.schedule_time.FromSeconds(schedule_seconds)
+    return task
+
 @https_fn.on_request()
 def schedule_notification(req: https_fn.Request) -> https_fn.Response:
     """
@@ -76,71 +436,48 @@ def schedule_notification(req: https_fn.Request) -> https_fn.Response:
     """
     if req.method != "POST":
         return https_fn.Response(
-            json.dumps({"error": "Only POST requests are accepted"}),
+            _dumps({"error": "Only POST requests are accepted"}),
             status=405,
             content_type="application/json"
         )
     
     try:
         # Get request body
-        request_data = req.get_json()
+        request_data = _loads(req.get_data(cache=False))
+        if not isinstance(request_data, dict):
+            return _bad_request("Invalid request body")
         
         if not request_data.get("token"):
-            return https_fn.Response(
-                json.dumps({"error": "Missing device token"}),
-                status=400,
-                content_type="application/json"
-            )
+            return _bad_request("Missing device token")
         
         # Get the token and notification data
         token = request_data.get("token")
         title = request_data.get("title", "Scheduled Notification")
         body = request_data.get("body", "This is a scheduled notification from Firebase")
-        delay_seconds = int(request_data.get("delay", 60))
+        delay_seconds = _parse_delay(request_data.get("delay", 60))
         
-        # Calculate the scheduled time
-        scheduled_time = datetime.now(UTC) + timedelta(seconds=delay_seconds)
-        
-        # Construct the parent queue path
-        parent = tasks_client.queue_path(project_id, location, queue_name)
+        error = _validate_notification([token], title, body)
+        if error:
+            return _bad_request(error)
+        if delay_seconds is None:
+            return _bad_request("Invalid delay")
         
-        # Construct the target URL (this is the URL of the function that will send the notification)
-        function_url = f"https://{location}-{project_id}.cloudfunctions.net/send_notification"
-        
-        # Create task payload
-        payload = {
-            "token": token,
-            "notification": {
-                "title": title,
-                "body": body
-            }
-        }
-        
-        # Convert payload to bytes (required by Cloud Tasks)
-        payload_bytes = json.dumps(payload).encode()
-        
-        # Create the task
-        task = {
-            "http_request": {
-                "http_method": tasks_v2.HttpMethod.POST,
-                "url": function_url,
-                "headers": {"Content-Type": "application/json"},
-                "body": payload_bytes
-            },
-            "schedule_time": scheduled_time.isoformat() + "Z"
-        }
+        # Calculate the scheduled time
+        schedule_seconds = int(time.time()) + delay_seconds
         
         # Create the task in Cloud Tasks
-        response = tasks_client.create_task(parent=parent, task=task)
+        task = _build_task(token, title, body, schedule_seconds)
+        response = _get_tasks().create_task(parent=_get_queue_parent(), task=task)
         
         # Return success
+        scheduled_time_str = datetime.fromtimestamp(schedule_seconds, UTC).isoformat()
         return https_fn.Response(
-            json.dumps({
+            _dumps({
                 "success": True,
                 "scheduled": True,
                 "task_name": response.name,
-                "scheduled_time": scheduled_time.isoformat(),
-                "message": f"Notification scheduled for {scheduled_time.isoformat()}"
+                "scheduled_time": scheduled_time_str,
+                "message": "Notification scheduled for " + scheduled_time_str
             }),
             status=200,
             content_type="application/json"
@@ -148,60 +485,548 @@ def schedule_notification(req: https_fn.Request) -> https_fn.Response:
         
     except Exception as e:
         return https_fn.Response(
-            json.dumps({"error": str(e)}),
+            _dumps({"error": str(e)}),
             status=500,
             content_type="application/json"
         )
 
+@https_fn.on_request()
+def schedule_notifications_bulk(req: https_fn.Request) -> https_fn.Response:
+    """
+    HTTP function to schedule many notifications in one request
+    
+    Accepts at most MAX_BULK_NOTIFICATIONS notifications. The Cloud Tasks are created
+    concurrently, up to BULK_SCHEDULE_WORKERS at a time. Responds with NDJSON: a line
+    with the counts, then one line per notification.
+    
+    Expected request body:
+    {
+        "notifications": [
+            {
+                "token": "FCM device token",
+                "title": "Notification title",
+                "body": "Notification body",
+                "delay": 60  # Delay in seconds
+            },
+            ...
+        ]
+    }
+    """
+    if req.method != "POST":
+        return https_fn.Response(
+            _dumps({"error": "Only POST requests are accepted"}),
+            status=405,
+            content_type="application/json"
+        )
+    
+    try:
+        request_data = _loads(req.get_data(cache=False))
+        if not isinstance(request_data, dict):
+            return _bad_request("Invalid request body")
+        notifications = request_data.get("notifications") or []
+        
+        if not isinstance(notifications, list) or not notifications:
+            return _bad_request("Missing notifications")
+        if len(notifications) > MAX_BULK_NOTIFICATIONS:
+            return _bad_request(f"At most {MAX_BULK_NOTIFICATIONS} notifications per request")
+        
+        entries = []
+        for notification in notifications:
+            if not isinstance(notification, dict):
+                return _bad_request("Invalid notification")
+            if not notification.get("token"):
+                return _bad_request("Missing device token")
+            token = notification["token"]
+            title = notification.get("title", "Scheduled Notification")
+            body = notification.get("body", "This is a scheduled notification from Firebase")
+            delay_seconds = _parse_delay(notification.get("delay", 60))
+            error = _validate_notification([token], title, body)
+            if error:
+                return _bad_request(error)
+            if delay_seconds is None:
+                return _bad_request("Invalid delay")
+            entries.append((token, title, body, delay_seconds))
+        
+        tasks_client = _get_tasks()
+        parent = _get_queue_parent()
+        
+        now = int(time.time())
+        schedule_seconds = [now + entry[3] for entry in entries]
+        tasks = [
+            _build_task(token, title, body, seconds)
+            for (token, title, body, _), seconds in zip(entries, schedule_seconds)
+        ]
+        
+        # The client is thread-safe; with at most DEFAULT_POOLSIZE workers every call reuses a pooled connection
+        with concurrent.futures.ThreadPoolExecutor(max_workers=BULK_SCHEDULE_WORKERS) as executor:
+            futures = [executor.submit(tasks_client.create_task, parent=parent, task=task) for task in tasks]
+        
+        results = []
+        for notification, seconds, future in zip(notifications, schedule_seconds, futures):
+            try:
+                results.append({
+                    "token": notification["token"],
+                    "success": True,
+                    "task_name": future.result().name,
+                    "scheduled_time": datetime.fromtimestamp(seconds, UTC).isoformat()
+                })
+            except Exception as e:
+                results.append({"token": notification["token"], "success": False, "error": str(e)})
+        
+        return _ndjson_response(_batch_summary(results))
+        
+    except Exception as e:
+        return https_fn.Response(
+            _dumps({"error": str(e)}),
+            status=500,
+            content_type="application/json"
+        )
+
+# Opt-in: send_notification acknowledges with 202 and sends in the background.
+# Cloud Tasks will not retry a send that fails or is lost after the ack, and CPU is
+# throttled once the response is sent, so only enable this where retries are handled upstream.
+SEND_ASYNC = os.environ.get('SEND_ASYNC', 'false').lower() == 'true'
+
+_send_pool = concurrent.futures.ThreadPoolExecutor(max_workers=64)
+
+def _log_failed_results(summary: dict) -> None:
+    """Log every failed result of a batch summary to Cloud Logging"""
+    for result in summary["responses"]:
+        if not result["success"]:
+            logging.error("Failed to send notification to %s: %s", result["token"], result["error"])
+
+def _log_send_result(future: concurrent.futures.Future) -> None:
+    """Log failures of a background send to Cloud Logging"""
+    try:
+        summary = future.result()
+    except Exception:
+        logging.exception("Background notification send failed")
+        return
+    _log_failed_results(summary)
+
+# Attempts per token for "tokens" sends, including the first one
+MAX_SEND_ATTEMPTS = 5
+
+# Base delay before retrying failed tokens; multiplied by the attempt number
+RETRY_DELAY_SECONDS = 60
+
+def _retry_failed_tokens(summary: dict, title: str, body: str, attempt: int) -> str | None:
+    """
+    Schedule a send_notification task for the tokens that failed with a retryable error
+    
+    Returns the retry task name, or None if nothing needs retrying or the attempts are used up.
+    """
+    tokens = [result["token"] for result in summary["responses"] if result.get("retryable")]
+    if not tokens:
+        return None
+    if attempt >= MAX_SEND_ATTEMPTS:
+        logging.error("Giving up on %d notification tokens after %d attempts", len(tokens), attempt)
+        return None
+    
+    payload = _dumps({
+        "tokens": tokens,
+        "notification": {"title": title, "body": body},
+        "attempt": attempt + 1
+    })
+    task = _build_task_with_payload(payload, int(time.time()) + RETRY_DELAY_SECONDS * attempt)
+    return _get_tasks().create_task(parent=_get_queue_parent(), task=task).name
+
 @https_fn.on_request()
 def send_notification(req: https_fn.Request) -> https_fn.Response:
     """
     HTTP function that actually sends the notification
     This is called by Cloud Tasks when a scheduled task is due
+    
+    A single "token" that fails returns 500 so Cloud Tasks retries it. For a
+    "tokens" list the response is 200 so tokens that were delivered are not sent
+    again; tokens that failed with a retryable error are re-sent by a new task
+    scheduled just for them, up to MAX_SEND_ATTEMPTS. If that task cannot be
+    created the response is 500 and Cloud Tasks retries the whole list.
+    
+    With SEND_ASYNC the send runs on a thread pool and the task is acknowledged
+    with 202 straight away; failures are only logged.
     """
     if req.method != "POST":
         return https_fn.Response("Only POST requests are accepted", status=405)
     
     try:
         # Get the request data
-        request_data = req.get_json()
+        request_data = _loads(req.get_data(cache=False))
+        if not isinstance(request_data, dict):
+            return https_fn.Response("Invalid request body", status=400)
         
         # Extract notification data
-        token = request_data.get("token")
+        tokens, is_batch = _get_tokens(request_data)
         notification_data = request_data.get("notification", {})
         
-        if not token:
+        if not isinstance(notification_data, dict):
+            return https_fn.Response("Invalid notification", status=400)
+        if not tokens:
             return https_fn.Response("Missing token", status=400)
         
-        # Create and send the FCM message
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=notification_data.get("title", "Notification"),
-                body=notification_data.get("body", "You have a notification")
-            ),
-            token=token,
-            apns=messaging.APNSConfig(
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(
-                        badge=1,
-                        sound="default"
-                    )
-                )
+        title = notification_data.get("title", "Notification")
+        body = notification_data.get("body", "You have a notification")
+        
+        error = _validate_notification(tokens, title, body)
+        if error:
+            return https_fn.Response(error, status=400)
+        
+        if SEND_ASYNC:
+            future = _send_pool.submit(_send_multicast, tokens, title, body)
+            future.add_done_callback(_log_send_result)
+            return https_fn.Response(
+                _dumps({"accepted": True}),
+                status=202,
+                content_type="application/json"
             )
-        )
         
-        # Send the message
-        response = messaging.send(message)
+        result = _send_to_request_tokens(tokens, is_batch, title, body)
+        
+        if is_batch:
+            attempt = request_data.get("attempt", 1)
+            if isinstance(attempt, bool) or not isinstance(attempt, int) or attempt < 1:
+                attempt = 1
+            result["retry_task"] = _retry_failed_tokens(result, title, body, attempt)
         
         return https_fn.Response(
-            json.dumps({"success": True, "message_id": response}),
+            _dumps(result),
             status=200,
             content_type="application/json"
         )
     
     except Exception as e:
         return https_fn.Response(
-            json.dumps({"error": str(e)}),
+            _dumps({"error": str(e)}),
+            status=500,
+            content_type="application/json"
+        )
+
+@https_fn.on_request()
+def send_bulk_notifications(req: https_fn.Request) -> https_fn.Response:
+    """
+    HTTP function to send notifications to many devices in batched FCM requests
+    
+    Accepts at most MAX_BULK_NOTIFICATIONS tokens or notifications. Responds with
+    NDJSON: a line with the counts, then one line per token.
+    
+    Expected request body, either the same notification for every token:
+    {
+        "tokens": ["FCM device token", ...],
+        "title": "Notification title",
+        "body": "Notification body"
+    }
+    or an individual notification per token:
+    {
+        "notifications": [
+            {"token": "FCM device token", "title": "Notification title", "body": "Notification body"},
+            ...
+        ]
+    }
+    """
+    if req.method != "POST":
+        return https_fn.Response(
+            _dumps({"error": "Only POST requests are accepted"}),
+            status=405,
+            content_type="application/json"
+        )
+    
+    try:
+        request_data = _loads(req.get_data(cache=False))
+        if not isinstance(request_data, dict):
+            return _bad_request("Invalid request body")
+        notifications = request_data.get("notifications")
+        
+        if notifications is not None:
+            if not isinstance(notifications, list):
+                return _bad_request("Missing notifications")
+            if len(notifications) > MAX_BULK_NOTIFICATIONS:
+                return _bad_request(f"At most {MAX_BULK_NOTIFICATIONS} notifications per request")
+            for notification in notifications:
+                if not isinstance(notification, dict):
+                    return _bad_request("Invalid notification")
+                if not notification.get("token"):
+                    return _bad_request("Missing device token")
+                error = _validate_notification(
+                    [notification["token"]],
+                    notification.get("title", "Notification"),
+                    notification.get("body", "You have a notification")
+                )
+                if error:
+                    return _bad_request(error)
+            summary = _send_each(notifications)
+        else:
+            tokens, _ = _get_tokens(request_data)
+            if not tokens:
+                return _bad_request("Missing device tokens")
+            if len(tokens) > MAX_BULK_NOTIFICATIONS:
+                return _bad_request(f"At most {MAX_BULK_NOTIFICATIONS} tokens per request")
+            title = request_data.get("title", "Notification")
+            body = request_data.get("body", "You have a notification")
+            error = _validate_notification(tokens, title, body)
+            if error:
+                return _bad_request(error)
+            summary = _send_multicast(tokens, title, body)
+        
+        return _ndjson_response(summary)
+    
+    except Exception as e:
+        return https_fn.Response(
+            _dumps({"error": str(e)}),
+            status=500,
+            content_type="application/json"
+        )
+
+# Latency tolerance buckets (seconds) for enqueue_notification. A notification
+# with tolerance T may wait in any bucket <= T; it goes to the largest one so it
+# batches with as many others as possible.
+TOLERANCE_BUCKETS = (5, 60, 300)
+
+# Flush a bucket before its deadline once it fills this many messages per FCM request
+FLUSH_UTILITY_THRESHOLD = 100
+
+# Opt-in: enqueue_notification holds notifications in memory on the instance that
+# received them. As with SEND_ASYNC, CPU is throttled once the response is sent and the
+# instance may be reclaimed, so queued notifications can be late or lost. When disabled,
+# enqueue_notification sends straight away.
+QUEUED_DELIVERY = os.environ.get('QUEUED_DELIVERY', 'false').lower() == 'true'
+
+# Per-instance virtual queues of pending notifications, keyed by bucket
+_queues = {bucket: [] for bucket in TOLERANCE_BUCKETS}
+_queues_lock = threading.Lock()
+_flush_timer = None
+_flush_at = None
+
+def _parse_tolerance(value) -> float | None:
+    """Return `value` as a tolerance in seconds, or None if it is not a non-negative finite number"""
+    if isinstance(value, bool):
+        return None
+    try:
+        tolerance = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(tolerance) or tolerance < 0:
+        return None
+    return tolerance
+
+def _bucket_for(tolerance: float):
+    """Return the largest bucket eligible for `tolerance`, or None if none is"""
+    eligible = [bucket for bucket in TOLERANCE_BUCKETS if bucket <= tolerance]
+    return eligible[-1] if eligible else None
+
+def _utility(bucket: int) -> float:
+    """Messages delivered per FCM batch request if `bucket` were flushed now"""
+    pending = len(_queues[bucket])
+    http_cost = -(-pending // FCM_BATCH_SIZE)
+    return pending / http_cost if http_cost else 0.0
+
+def _take_batches(force: bool = False) -> list:
+    """
+    Remove and return the queued batches that should be sent now
+    
+    A bucket is taken when its oldest notification reaches its deadline, or when
+    it is the highest-utility bucket and crosses FLUSH_UTILITY_THRESHOLD.
+    """
+    now = time.monotonic()
+    batches = []
+    with _queues_lock:
+        for bucket in TOLERANCE_BUCKETS:
+            queue = _queues[bucket]
+            if queue and (force or queue[0]["deadline"] <= now):
+                batches.append(queue)
+                _queues[bucket] = []
+        
+        best = max(TOLERANCE_BUCKETS, key=_utility)
+        if _utility(best) >= FLUSH_UTILITY_THRESHOLD:
+            batches.append(_queues[best])
+            _queues[best] = []
+    return batches
+
+def _flush_queues(force: bool = False) -> dict:
+    """
+    Send every batch that is due and return the combined summary
+    
+    Notifications that fail with a retryable error go back into the smallest bucket,
+    up to MAX_SEND_ATTEMPTS; their results are marked "requeued".
+    """
+    results = []
+    retries = []
+    for batch in _take_batches(force):
+        by_token = {notification["token"]: notification for notification in batch}
+        for result in _send_each(batch)["responses"]:
+            notification = by_token[result["token"]]
+            if result.get("retryable") and notification["attempt"] < MAX_SEND_ATTEMPTS:
+                retries.append({
+                    **notification,
+                    "attempt": notification["attempt"] + 1,
+                    "deadline": time.monotonic() + TOLERANCE_BUCKETS[0]
+                })
+                result["requeued"] = True
+            results.append(result)
+    
+    if retries:
+        with _queues_lock:
+            _queues[TOLERANCE_BUCKETS[0]].extend(retries)
+        _ensure_flush_timer()
+    return _batch_summary(results)
+
+def _next_flush_at() -> float | None:
+    """Monotonic time the queues next need flushing, or None if they are empty (call under _queues_lock)"""
+    if _utility(max(TOLERANCE_BUCKETS, key=_utility)) >= FLUSH_UTILITY_THRESHOLD:
+        return time.monotonic()
+    deadlines = [queue[0]["deadline"] for queue in _queues.values() if queue]
+    return min(deadlines) if deadlines else None
+
+def _run_flush_timer() -> None:
+    global _flush_timer, _flush_at
+    try:
+        # Nobody waits on a timer flush, so failures must at least reach the logs
+        _log_failed_results(_flush_queues())
+    except Exception:
+        logging.exception("Failed to flush queued notifications")
+    with _queues_lock:
+        # A newer timer may have replaced this one while it was running
+        if _flush_timer is threading.current_thread():
+            _flush_timer = None
+            _flush_at = None
+    _ensure_flush_timer()
+
+def _ensure_flush_timer() -> None:
+    """Arm the background flush timer for the earliest pending deadline"""
+    global _flush_timer, _flush_at
+    with _queues_lock:
+        flush_at = _next_flush_at()
+        if flush_at is None or (_flush_timer is not None and _flush_at <= flush_at):
+            return
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+        # Fire at the deadline itself so no notification waits longer than its bucket
+        _flush_at = flush_at
+        _flush_timer = threading.Timer(max(0.0, flush_at - time.monotonic()), _run_flush_timer)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+@https_fn.on_request()
+def enqueue_notification(req: https_fn.Request) -> https_fn.Response:
+    """
+    HTTP function to queue a notification for batched delivery within a latency tolerance
+    
+    With QUEUED_DELIVERY, notifications are held in per-instance queues and sent
+    together through FCM batch requests. A tolerance below the smallest bucket, or
+    QUEUED_DELIVERY being off, sends immediately.
+    
+    Queued notifications live only in this instance's memory. They can be delivered
+    late if CPU is throttled after the 202, and are lost if the instance is reclaimed
+    before its timer flushes them.
+    
+    Expected request body:
+    {
+        "token": "FCM device token",
+        "title": "Notification title",
+        "body": "Notification body",
+        "tolerance_seconds": 60  # Maximum acceptable delivery delay
+    }
+    """
+    if req.method != "POST":
+        return https_fn.Response(
+            _dumps({"error": "Only POST requests are accepted"}),
+            status=405,
+            content_type="application/json"
+        )
+    
+    try:
+        request_data = _loads(req.get_data(cache=False))
+        if not isinstance(request_data, dict):
+            return _bad_request("Invalid request body")
+        token = request_data.get("token")
+        
+        if not token:
+            return _bad_request("Missing device token")
+        
+        title = request_data.get("title", "Notification")
+        body = request_data.get("body", "You have a notification")
+        
+        error = _validate_notification([token], title, body)
+        if error:
+            return _bad_request(error)
+        
+        if _is_dead_token(token):
+            return https_fn.Response(
+                _dumps({"queued": False, "success": False, "error": "unregistered"}),
+                status=200,
+                content_type="application/json"
+            )
+        
+        tolerance = _parse_tolerance(request_data.get("tolerance_seconds", 0))
+        if tolerance is None:
+            return _bad_request("Invalid tolerance_seconds")
+        
+        bucket = _bucket_for(tolerance) if QUEUED_DELIVERY else None
+        
+        if bucket is None:
+            return https_fn.Response(
+                _dumps({"queued": False, "success": True, "message_id": _send_one(token, title, body)}),
+                status=200,
+                content_type="application/json"
+            )
+        
+        with _queues_lock:
+            _queues[bucket].append({
+                "token": token,
+                "title": title,
+                "body": body,
+                "attempt": 1,
+                "deadline": time.monotonic() + bucket
+            })
+        _ensure_flush_timer()
+        
+        return https_fn.Response(
+            _dumps({"queued": True, "bucket": bucket}),
+            status=202,
+            content_type="application/json"
+        )
+    
+    except Exception as e:
+        return https_fn.Response(
+            _dumps({"error": str(e)}),
+            status=500,
+            content_type="application/json"
+        )
+
+@https_fn.on_request()
+def flush_notifications(req: https_fn.Request) -> https_fn.Response:
+    """
+    HTTP function to send queued notifications that are due
+    
+    Only flushes the queues of the instance that receives the request, so it is a
+    supplement to the per-instance timer, not a replacement for it.
+    
+    Responds with NDJSON: a line with the counts, then one line per token.
+    
+    Expected request body (optional):
+    {
+        "force": true  # Send every queued notification regardless of deadline
+    }
+    """
+    if req.method != "POST":
+        return https_fn.Response(
+            _dumps({"error": "Only POST requests are accepted"}),
+            status=405,
+            content_type="application/json"
+        )
+    
+    try:
+        data = req.get_data(cache=False)
+        request_data = _loads(data) if data else {}
+        if not isinstance(request_data, dict):
+            return _bad_request("Invalid request body")
+        force = bool(request_data.get("force"))
+        summary = _flush_queues(force)
+        
+        return _ndjson_response(summary)
+    
+    except Exception as e:
+        return https_fn.Response(
+            _dumps({"error": str(e)}),
             status=500,
             content_type="application/json"
         )
\ No newline at end of file
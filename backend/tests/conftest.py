@@ -0,0 +1,71 @@
+"""
+Stub the Firebase and Google Cloud SDKs so main.py can be imported without credentials
+
+Only the names main.py touches are provided; tests patch individual calls as needed.
+"""
+import os
+import sys
+import types
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+class _Response:
+    def __init__(self, response=None, status=200, content_type=None):
+        self.response = response
+        self.status = status
+        self.content_type = content_type
+
+
+_https_fn = _module(
+    "firebase_functions.https_fn",
+    on_call=lambda **kwargs: (lambda f: f),
+    on_request=lambda **kwargs: (lambda f: f),
+    Request=object,
+    CallableRequest=object,
+    Response=_Response
+)
+_module("firebase_functions", https_fn=_https_fn)
+
+_messaging = _module(
+    "firebase_admin.messaging",
+    APNSConfig=mock.MagicMock(),
+    APNSPayload=mock.MagicMock(),
+    Aps=mock.MagicMock(),
+    Message=mock.MagicMock(),
+    MulticastMessage=mock.MagicMock(),
+    Notification=mock.MagicMock(),
+    UnregisteredError=type("UnregisteredError", (Exception,), {}),
+    QuotaExceededError=type("QuotaExceededError", (Exception,), {}),
+    send=mock.MagicMock(),
+    send_each=mock.MagicMock(),
+    send_each_for_multicast=mock.MagicMock()
+)
+_exceptions = _module(
+    "firebase_admin.exceptions",
+    UnavailableError=type("UnavailableError", (Exception,), {}),
+    InternalError=type("InternalError", (Exception,), {}),
+    DeadlineExceededError=type("DeadlineExceededError", (Exception,), {})
+)
+_module("firebase_admin", initialize_app=mock.MagicMock(), messaging=_messaging, exceptions=_exceptions)
+
+_tasks_v2 = _module("google.cloud.tasks_v2", CloudTasksClient=mock.MagicMock(), Task=mock.MagicMock(),
+                    HttpRequest=mock.MagicMock(), HttpMethod=mock.MagicMock())
+_auth = _module("google.auth", default=mock.MagicMock(return_value=(None, "test-project")))
+_module("google.cloud", tasks_v2=_tasks_v2)
+_module("google", auth=_auth)
+
+_module("cachetools", TTLCache=lambda maxsize, ttl: {})
+
+try:
+    import requests.adapters  # noqa: F401
+except ImportError:
+    _module("requests.adapters", DEFAULT_POOLSIZE=10)
@@ -0,0 +1,156 @@
+import orjson
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def reset_queues(monkeypatch):
+    monkeypatch.setattr(main, "_queues", {bucket: [] for bucket in main.TOLERANCE_BUCKETS})
+    monkeypatch.setattr(main, "_flush_timer", None)
+    monkeypatch.setattr(main, "_flush_at", None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controllable replacement for time.monotonic"""
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def created_tasks(monkeypatch):
+    """Capture the payloads of tasks created through _build_task_with_payload"""
+    payloads = []
+    monkeypatch.setattr(main, "_build_task_with_payload", lambda payload, seconds: payloads.append(payload))
+    monkeypatch.setattr(main, "_get_queue_parent", lambda: "queue")
+    tasks_client = main.tasks_v2.CloudTasksClient()
+    tasks_client.create_task.return_value.name = "retry-task"
+    monkeypatch.setattr(main, "_get_tasks", lambda: tasks_client)
+    return payloads
+
+
+def _queued(token, deadline, attempt=1):
+    return {"token": token, "title": "t", "body": "b", "attempt": attempt, "deadline": deadline}
+
+
+class TestParseDelay:
+    @pytest.mark.parametrize("value, expected", [
+        (0, 0),
+        (60, 60),
+        ("60", 60),
+        (60.0, 60),
+        (main.MAX_DELAY_SECONDS, main.MAX_DELAY_SECONDS)
+    ])
+    def test_accepts(self, value, expected):
+        assert main._parse_delay(value) == expected
+
+    @pytest.mark.parametrize("value", [
+        -1, 60.5, float("nan"), float("inf"), True, None, "abc", "²", "60.0",
+        main.MAX_DELAY_SECONDS + 1
+    ])
+    def test_rejects(self, value):
+        assert main._parse_delay(value) is None
+
+
+class TestParseTolerance:
+    @pytest.mark.parametrize("value, expected", [(0, 0.0), (5, 5.0), ("60", 60.0), (2.5, 2.5)])
+    def test_accepts(self, value, expected):
+        assert main._parse_tolerance(value) == expected
+
+    @pytest.mark.parametrize("value", [-1, "abc", None, True, float("nan"), float("inf"), [5]])
+    def test_rejects(self, value):
+        assert main._parse_tolerance(value) is None
+
+
+class TestRetryFailedTokens:
+    summary = {"responses": [
+        {"token": "ok", "success": True, "message_id": "m"},
+        {"token": "busy", "success": False, "error": "quota", "retryable": True},
+        {"token": "gone", "success": False, "error": "unregistered"},
+        {"token": "bad", "success": False, "error": "invalid", "retryable": False}
+    ]}
+
+    def test_reschedules_only_retryable_tokens(self, created_tasks):
+        assert main._retry_failed_tokens(self.summary, "t", "b", 1) == "retry-task"
+        assert len(created_tasks) == 1
+        payload = orjson.loads(created_tasks[0])
+        assert payload["tokens"] == ["busy"]
+        assert payload["attempt"] == 2
+
+    def test_stops_at_max_attempts(self, created_tasks):
+        assert main._retry_failed_tokens(self.summary, "t", "b", main.MAX_SEND_ATTEMPTS) is None
+        assert created_tasks == []
+
+    def test_nothing_to_retry(self, created_tasks):
+        summary = {"responses": self.summary["responses"][:1]}
+        assert main._retry_failed_tokens(summary, "t", "b", 1) is None
+        assert created_tasks == []
+
+
+class TestFlushScheduling:
+    def test_bucket_waits_until_deadline(self, clock):
+        main._queues[60].append(_queued("a", clock[0] + 60))
+        assert main._take_batches() == []
+        clock[0] += 60
+        assert [entry["token"] for batch in main._take_batches() for entry in batch] == ["a"]
+        assert main._queues[60] == []
+
+    def test_timer_armed_for_earliest_deadline(self, clock, monkeypatch):
+        timers = []
+
+        class FakeTimer:
+            def __init__(self, interval, function):
+                self.interval = interval
+                self.cancelled = False
+                timers.append(self)
+
+            def start(self):
+                pass
+
+            def cancel(self):
+                self.cancelled = True
+
+        monkeypatch.setattr(main.threading, "Timer", FakeTimer)
+        main._queues[60].append(_queued("a", clock[0] + 60))
+        main._ensure_flush_timer()
+        assert timers[-1].interval == 60
+
+        # A sooner deadline replaces the pending timer
+        main._queues[5].append(_queued("b", clock[0] + 5))
+        main._ensure_flush_timer()
+        assert timers[0].cancelled
+        assert timers[-1].interval == 5
+
+        # A later deadline leaves it alone
+        main._queues[300].append(_queued("c", clock[0] + 300))
+        main._ensure_flush_timer()
+        assert len(timers) == 2
+
+    def test_utility_threshold_flushes_before_deadline(self, clock):
+        main._queues[300].extend(
+            _queued(f"t{i}", clock[0] + 300) for i in range(main.FLUSH_UTILITY_THRESHOLD)
+        )
+        assert main._next_flush_at() == clock[0]
+        batches = main._take_batches()
+        assert len(batches) == 1 and len(batches[0]) == main.FLUSH_UTILITY_THRESHOLD
+
+    def test_below_threshold_is_not_flushed_early(self, clock):
+        main._queues[300].extend(
+            _queued(f"t{i}", clock[0] + 300) for i in range(main.FLUSH_UTILITY_THRESHOLD - 1)
+        )
+        assert main._next_flush_at() == clock[0] + 300
+        assert main._take_batches() == []
+
+    def test_retryable_failures_are_requeued(self, clock, monkeypatch):
+        main._queues[5].extend([_queued("busy", clock[0]), _queued("spent", clock[0], attempt=main.MAX_SEND_ATTEMPTS)])
+        monkeypatch.setattr(main, "_ensure_flush_timer", lambda: None)
+        monkeypatch.setattr(main, "_send_each", lambda batch: {"responses": [
+            {"token": entry["token"], "success": False, "error": "quota", "retryable": True}
+            for entry in batch
+        ]})
+        summary = main._flush_queues()
+        assert summary["failure_count"] == 2
+        assert [entry["token"] for entry in main._queues[5]] == ["busy"]
+        assert main._queues[5][0]["attempt"] == 2